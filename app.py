@@ -2,19 +2,32 @@
 # - Gumroad license gate (users unlock with purchase key)
 # - Admin override code (lets you in without purchase)
 # - Uses your master OPENAI_API_KEY (no BYOK)
-# - Daily usage cap + cooldown + midnight reset
+# - Daily usage cap (token bucket, refills through the day) + cooldown
 # - Clean UI, strong contrast for results, no creativity slider
 # - De-duplicated model list, example address = "e.g., London N1"
 
+import io
 import os
+import json
+import asyncio
+import threading
+import re
 import time
-import textwrap
-import requests
-import datetime as dt
+import hmac
+import base64
+import hashlib
+import tempfile
+import itertools
+import collections
+from dataclasses import dataclass, field
 import streamlit as st
-from typing import Optional, List, Dict, Any
+from typing import TYPE_CHECKING, Optional, List, Dict, Any, Tuple
 from dotenv import load_dotenv
-from openai import OpenAI
+
+# requests/openai are imported lazily (behind the license gate) to keep the gate page fast
+if TYPE_CHECKING:
+    import requests
+    from openai import OpenAI
 
 # ================== Config & Secrets ==================
 load_dotenv()
@@ -28,6 +41,7 @@ def get_secret(name: str, default: Optional[str] = None) -> Optional[str]:
 # Required (your master API key; users never see this)
 OPENAI_API_KEY = get_secret("OPENAI_API_KEY")
 DEFAULT_MODEL  = get_secret("OPENAI_DEFAULT_MODEL", "gpt-4o-mini")
+BATCH_MODEL    = get_secret("OPENAI_BATCH_MODEL", "gpt-4o-mini")  # bulk history regeneration
 
 # License gate (Gumroad permalink slug, e.g., "real-estate-listing-gen-pro")
 GUMROAD_PRODUCT_PERMALINK = get_secret("GUMROAD_PRODUCT_PERMALINK", "")
@@ -35,17 +49,47 @@ GUMROAD_PRODUCT_PERMALINK = get_secret("GUMROAD_PRODUCT_PERMALINK", "")
 # Admin override (enter this at the gate to unlock without purchase)
 ADMIN_OVERRIDE_CODE = get_secret("ADMIN_BYPASS", "")  # leave blank to disable
 
+# Signs the unlock token kept in the URL so reruns/refreshes skip Gumroad (blank = disabled)
+LICENSE_TOKEN_SECRET = get_secret("LICENSE_TOKEN_SECRET", "")
+LICENSE_TOKEN_TTL    = 24 * 60 * 60  # seconds
+
 # Usage controls
 USAGE_DAILY_LIMIT      = int(get_secret("USAGE_DAILY_LIMIT", "50"))      # generations/day
 USAGE_COOLDOWN_SECONDS = int(get_secret("USAGE_COOLDOWN_SECONDS", "5"))  # seconds between clicks
+USAGE_REFILL_RATE      = USAGE_DAILY_LIMIT / 86400                        # tokens/second
+
+# License verification cache (seconds); failed keys expire sooner
+LICENSE_CACHE_TTL     = 3600
+LICENSE_NEGATIVE_TTL  = 60
+LICENSE_CACHE_ENTRIES = 256
+
+# Successful verifications also persist on disk (hashes only) so restarts skip Gumroad
+LICENSE_DISK_CACHE = get_secret("LICENSE_DISK_CACHE", ".license_cache.json")  # blank = disabled
+LICENSE_DISK_TTL   = 24 * 60 * 60  # seconds
+
+# Identical re-submissions reuse previous variants (no API call, no usage)
+GENERATION_CACHE_TTL     = int(get_secret("GENERATION_CACHE_TTL", "86400"))  # seconds
+GENERATION_CACHE_ENTRIES = 256
+
+# Session history (older entries drop off automatically)
+HISTORY_MAX = 50
 
 # Model temperature (fixed; no slider)
 TEMPERATURE = 0.7
 
+# Widget options (module-level tuples, not rebuilt per rerun; DEFAULT model first, de-duplicated)
+MODEL_OPTIONS    = tuple(dict.fromkeys((DEFAULT_MODEL, "gpt-4o-mini", "gpt-4o")))
+VARIANT_OPTIONS  = (1, 2, 3)
+PROPERTY_TYPES   = ("Flat/Apartment", "House", "Studio", "Bungalow", "Townhouse", "New Build", "Other")
+TONES            = ("Professional", "Warm", "Luxury", "Concise", "Investor-Focused", "Family-Friendly")
+AUDIENCES        = ("General buyers", "First-time buyers", "Families", "Investors", "Renters")
+SPELLINGS        = ("UK", "US")
+FORMAT_CHOICES   = ("Paragraphs", "Short summary + paragraph", "Headline + paragraph")
+
 # ================== Page & Styles ==================
 st.set_page_config(page_title="Real Estate Listing Generator", page_icon="🏠", layout="centered")
 
-st.markdown("""
+PAGE_CSS = """
 <style>
 /* Layout */
 .block-container { padding-top: 2rem; }
@@ -79,51 +123,214 @@ hr { border:none; border-top:1px solid #eee; margin: 18px 0; }
 .small { color:#666; font-size:0.9rem; }
 .variant-title { font-weight:600; margin-top:8px; }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_resource
+def _minified_css() -> str:
+    """PAGE_CSS without comments/extra whitespace, computed once per process."""
+    return re.sub(r"\s+", " ", re.sub(r"/\*.*?\*/", "", PAGE_CSS, flags=re.S)).strip()
+
+# The <style> element must still be emitted every rerun (Streamlit drops elements a
+# rerun doesn't re-send), so the win is a smaller payload, not skipping the call
+st.markdown(_minified_css(), unsafe_allow_html=True)
 
 st.title("🏠 Real Estate Listing Generator")
-# Show this caption ONLY before the user unlocks
-if not st.session_state.get("licensed", False):
-    st.caption("Unlock with your purchase key. Admins can use a private override code.")
 
 # ================== Guards ==================
 if not OPENAI_API_KEY:
     st.error("Server misconfigured: missing OPENAI_API_KEY (set it in Streamlit Secrets).")
     st.stop()
 
+# ================== Usage Tracking ==================
+@dataclass(slots=True)
+class Usage:
+    # Token bucket: one token per generation, refilled continuously up to the daily cap
+    tokens: float = float(USAGE_DAILY_LIMIT)
+    last_refill: float = field(default_factory=time.monotonic)
+    last_ts: float = 0.0  # time.monotonic() of last generation (cooldown)
+    bypass: bool = False  # True when admin override is accepted
+
+def refill_usage(usage: Usage, mono: float) -> None:
+    usage.tokens = min(float(USAGE_DAILY_LIMIT), usage.tokens + (mono - usage.last_refill) * USAGE_REFILL_RATE)
+    usage.last_refill = mono
+
 # ================== Session State ==================
 if "licensed" not in st.session_state:
     st.session_state.licensed = False
 if "history" not in st.session_state:
-    st.session_state.history = []
+    st.session_state.history = collections.deque(maxlen=HISTORY_MAX)
 if "last_variants" not in st.session_state:
     st.session_state.last_variants = []
+if "history_batch" not in st.session_state:
+    # {"id", "size", "labels", "charged", "report"}; the id is also kept in the URL (?b=)
+    # so a refreshed tab can still collect results it paid for (nothing to refund there)
+    restored = st.query_params.get("b", "")
+    st.session_state.history_batch = (
+        {"id": restored, "size": 0, "labels": [], "charged": 0, "report": None} if restored else None
+    )
 if "usage" not in st.session_state:
-    st.session_state.usage = {
-        "date": dt.date.today().isoformat(),
-        "count": 0,
-        "last_ts": 0.0,
-        "bypass": False,  # True when admin override is accepted
-    }
+    st.session_state.usage = Usage()
+
+# ================== Cache Helpers ==================
+# Process-wide caches are shared by every session's script thread: (lock, {key: (value, expires_at)})
+TTLCache = Tuple[Any, Dict[Any, Tuple[Any, float]]]
+
+def new_ttl_cache() -> TTLCache:
+    return threading.Lock(), {}
+
+def ttl_get(cache: TTLCache, key: Any, now: float) -> Optional[Any]:
+    """Return the cached value for key, or None if missing/expired."""
+    lock, entries = cache
+    with lock:
+        hit = entries.get(key)
+    return hit[0] if hit and hit[1] > now else None
+
+def ttl_put(cache: TTLCache, key: Any, value: Any, ttl: float, max_entries: int, now: float) -> None:
+    """Store value until now+ttl; evicts expired, then oldest, entries past max_entries."""
+    lock, entries = cache
+    with lock:
+        if len(entries) >= max_entries:
+            for k in [k for k, (_, exp) in entries.items() if exp <= now]:
+                del entries[k]
+            while len(entries) >= max_entries:
+                del entries[next(iter(entries))]
+        entries[key] = (value, now + ttl)
 
 # ================== License Helpers ==================
+@st.cache_resource
+def _gumroad_session() -> "requests.Session":
+    """Pooled HTTP session for Gumroad (kept alive across reruns)."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return s
+
+@st.cache_resource
+def _license_cache() -> TTLCache:
+    """(sha256(key), permalink) -> (valid, expires_at). Raw keys are never stored."""
+    return new_ttl_cache()
+
+GUMROAD_VERIFY_ATTEMPTS = 3
+GUMROAD_VERIFY_DEADLINE = 6.0  # seconds across all attempts
+
+def _verify_gumroad_remote(license_key: str, product_permalink: str) -> Optional[bool]:
+    """Ask Gumroad about the key. None means the check itself failed (network etc.)."""
+    url = "https://api.gumroad.com/v2/licenses/verify"
+    data = {
+        "product_permalink": product_permalink,
+        "license_key": license_key,
+        "increment_uses_count": False,
+    }
+    # Retry transient failures (network, 429, 5xx) with a short backoff, within an overall
+    # deadline; a clear "not valid" answer from Gumroad is returned immediately
+    deadline = time.monotonic() + GUMROAD_VERIFY_DEADLINE
+    for attempt in range(GUMROAD_VERIFY_ATTEMPTS):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        try:
+            r = _gumroad_session().post(url, data=data, timeout=(min(2.0, left), min(5.0, left)))
+            if r.status_code != 429 and r.status_code < 500:
+                j = r.json() if r.ok else {}
+                return bool(j.get("success"))
+        except Exception:
+            pass
+        backoff = 0.2 * (2 ** attempt)
+        if attempt < GUMROAD_VERIFY_ATTEMPTS - 1 and time.monotonic() + backoff < deadline:
+            time.sleep(backoff)
+    return None
+
+def _disk_cache_key(ck: Tuple[str, str]) -> str:
+    return f"{ck[1]}:{ck[0]}"
+
+def _read_disk_license(ck: Tuple[str, str], now: float) -> bool:
+    """True if a still-fresh successful verification for ck is on disk."""
+    if not LICENSE_DISK_CACHE:
+        return False
+    try:
+        with open(LICENSE_DISK_CACHE, "r", encoding="utf-8") as f:
+            return float(json.load(f).get(_disk_cache_key(ck), 0)) > now
+    except Exception:
+        return False
+
+def _write_disk_license(ck: Tuple[str, str], now: float) -> None:
+    """Record a successful verification (pruning expired ones); best effort."""
+    if not LICENSE_DISK_CACHE:
+        return
+    try:
+        try:
+            with open(LICENSE_DISK_CACHE, "r", encoding="utf-8") as f:
+                data = {k: v for k, v in json.load(f).items() if float(v) > now}
+        except Exception:
+            data = {}
+        data[_disk_cache_key(ck)] = now + LICENSE_DISK_TTL
+        # Unique temp file in the same directory, so concurrent writers never share one
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(LICENSE_DISK_CACHE)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, LICENSE_DISK_CACHE)
+        except Exception:
+            os.unlink(tmp)
+            raise
+    except Exception:
+        pass
+
 def verify_gumroad_license(license_key: str, product_permalink: str) -> bool:
-    """Return True if the Gumroad license is valid for the product."""
+    """Return True if the Gumroad license is valid for the product (cached with TTL)."""
+    cache = _license_cache()
+    ck = (hashlib.sha256(license_key.encode("utf-8")).hexdigest(), product_permalink)
+    now = time.time()
+
+    hit = ttl_get(cache, ck, now)
+    if hit is not None:
+        return hit
+    if _read_disk_license(ck, now):
+        ttl_put(cache, ck, True, LICENSE_CACHE_TTL, LICENSE_CACHE_ENTRIES, now)
+        return True
+
+    valid = _verify_gumroad_remote(license_key, product_permalink)
+    if valid is None:
+        return False  # transient failure: don't cache, let the user retry
+
+    ttl_put(cache, ck, valid, LICENSE_CACHE_TTL if valid else LICENSE_NEGATIVE_TTL, LICENSE_CACHE_ENTRIES, now)
+    if valid:
+        _write_disk_license(ck, now)
+    return valid
+
+def _sign(payload: str) -> str:
+    return hmac.new(LICENSE_TOKEN_SECRET.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def issue_license_token(license_key: str) -> str:
+    """Token = base64url("ts.sha256(key).hmac"); lets a refreshed tab unlock locally."""
+    payload = f"{int(time.time())}.{hashlib.sha256(license_key.encode('utf-8')).hexdigest()}"
+    raw = f"{payload}.{_sign(payload)}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def check_license_token(token: str) -> bool:
+    """Local HMAC check of an unlock token (no network). Expires after LICENSE_TOKEN_TTL."""
+    if not LICENSE_TOKEN_SECRET or not token:
+        return False
     try:
-        url = "https://api.gumroad.com/v2/licenses/verify"
-        data = {
-            "product_permalink": product_permalink,
-            "license_key": license_key,
-            "increment_uses_count": False,
-        }
-        r = requests.post(url, data=data, timeout=10)
-        j = r.json() if r.ok else {}
-        return bool(j.get("success"))
+        ts, key_hash, mac = base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8").split(".")
+        if not hmac.compare_digest(mac, _sign(f"{ts}.{key_hash}")):
+            return False
+        return 0 <= time.time() - int(ts) < LICENSE_TOKEN_TTL
     except Exception:
         return False
 
 def show_license_gate():
     """Gate: unlock with Gumroad license key or admin override."""
+    # A valid signed token from an earlier unlock skips the form entirely
+    if check_license_token(st.query_params.get("t", "")):
+        st.session_state.licensed = True
+        return
+    st.query_params.pop("t", None)
+
+    # Shown only before the user unlocks (after the token check, so token unlocks never see it)
+    st.caption("Unlock with your purchase key. Admins can use a private override code.")
+
     st.info("🔒 Enter your Access Key to unlock.", icon="🔑")
     with st.form("license_form"):
         access_key = st.text_input("Access Key", placeholder="Your Gumroad license key", type="password")
@@ -132,7 +339,7 @@ def show_license_gate():
     if ok:
         # Admin override first
         if ADMIN_OVERRIDE_CODE and access_key.strip() == ADMIN_OVERRIDE_CODE.strip():
-            st.session_state.usage["bypass"] = True
+            st.session_state.usage.bypass = True
             st.session_state.licensed = True
             st.success("Admin override accepted ✅")
             st.rerun()
@@ -142,9 +349,12 @@ def show_license_gate():
             st.error("Server misconfigured: missing GUMROAD_PRODUCT_PERMALINK. Contact support.")
             st.stop()
 
-        valid = verify_gumroad_license(access_key.strip(), GUMROAD_PRODUCT_PERMALINK)
+        with st.spinner("Verifying…"):
+            valid = verify_gumroad_license(access_key.strip(), GUMROAD_PRODUCT_PERMALINK)
         if valid:
             st.session_state.licensed = True
+            if LICENSE_TOKEN_SECRET:
+                st.query_params["t"] = issue_license_token(access_key.strip())
             st.success("License verified ✅")
             st.rerun()
         else:
@@ -157,31 +367,73 @@ if not st.session_state.licensed:
         st.stop()
 
 # ================== OpenAI Client ==================
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Idle pooled connections stay open this long (httpx's default is 5s, shorter than a form fill)
+HTTP_KEEPALIVE_EXPIRY = 120.0  # seconds
+
+def _http_client_kwargs() -> Dict[str, Any]:
+    """Shared httpx settings: keep-alive pool, bounded timeouts, HTTP/2 when `h2` is installed."""
+    import httpx
+    import importlib.util
+    return {
+        "limits": httpx.Limits(
+            max_connections=32, max_keepalive_connections=16, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(30.0, connect=5.0),
+        "http2": importlib.util.find_spec("h2") is not None,
+    }
+
+@st.cache_resource
+def get_openai_client(api_key: str) -> "OpenAI":
+    """One client per API key so its keep-alive pool survives reruns; a rotated key gets a fresh one."""
+    import httpx
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, http_client=httpx.Client(**_http_client_kwargs()))
+
+@st.cache_resource
+def _prewarm_state() -> Dict[str, Any]:
+    """Process-wide time of the last warm-up, shared by every session."""
+    return {"lock": threading.Lock(), "ts": float("-inf")}
+
+def _prewarm_openai(api_key: str) -> None:
+    """Open a pooled TLS connection to api.openai.com in the background.
+
+    Runs when a session first unlocks (users start filling the form then), and is skipped
+    while an earlier warm-up's connection is still inside HTTP_KEEPALIVE_EXPIRY.
+    """
+    if st.session_state.get("prewarmed"):
+        return
+    st.session_state.prewarmed = True
+    state = _prewarm_state()
+    with state["lock"]:
+        if time.monotonic() - state["ts"] < HTTP_KEEPALIVE_EXPIRY / 2:
+            return
+        state["ts"] = time.monotonic()
+
+    def warm():
+        try:
+            get_openai_client(api_key).with_options(timeout=3.0, max_retries=0).models.list()
+        except Exception:
+            pass  # best effort; the first real request just pays the handshake
+    threading.Thread(target=warm, daemon=True).start()
+
+client = get_openai_client(OPENAI_API_KEY)
+_prewarm_openai(OPENAI_API_KEY)
 
 # ================== Sidebar Controls ==================
 with st.sidebar:
     st.header("⚙️ Settings")
 
-    # De-duplicated model list (DEFAULT first)
-    models = list(dict.fromkeys([DEFAULT_MODEL, "gpt-4o-mini", "gpt-4o"]))
-    model = st.selectbox("Model", options=models, index=0)
+    model = st.selectbox("Model", options=MODEL_OPTIONS, index=0)
 
     # No creativity slider; fixed temperature
-    variants = st.select_slider("Number of variants", options=[1, 2, 3], value=2)
+    variants = st.select_slider("Number of variants", options=VARIANT_OPTIONS, value=2)
 
-    # Usage counters (reset at local midnight)
+    # Usage counters (token bucket refills gradually through the day)
     st.markdown("---")
-    today = dt.date.today().isoformat()
-    if st.session_state.usage["date"] != today:
-        st.session_state.usage["date"] = today
-        st.session_state.usage["count"] = 0
-        st.session_state.usage["last_ts"] = 0.0
-
-    remaining = max(0, USAGE_DAILY_LIMIT - st.session_state.usage["count"])
-    st.metric(label="Generations left (today)", value=remaining)
+    refill_usage(st.session_state.usage, time.monotonic())
+    st.metric(label="Generations available", value=int(st.session_state.usage.tokens))
 
-    if st.session_state.usage.get("bypass"):
+    if st.session_state.usage.bypass:
         st.success("Admin bypass active")
 
 # ================== Form ==================
@@ -195,9 +447,7 @@ with st.form("listing_form"):
     with col2:
         baths = st.number_input("Bathrooms", min_value=0, step=1, value=1)
     with col3:
-        property_type = st.selectbox("Property Type", [
-            "Flat/Apartment", "House", "Studio", "Bungalow", "Townhouse", "New Build", "Other"
-        ])
+        property_type = st.selectbox("Property Type", PROPERTY_TYPES)
 
     features = st.text_area(
         "Key Features (comma-separated)",
@@ -206,41 +456,52 @@ with st.form("listing_form"):
     )
 
     st.subheader("Style & Constraints")
-    tone = st.selectbox("Tone", [
-        "Professional", "Warm", "Luxury", "Concise", "Investor-Focused", "Family-Friendly"
-    ])
-    audience = st.selectbox("Target Audience", [
-        "General buyers", "First-time buyers", "Families", "Investors", "Renters"
-    ])
+    tone = st.selectbox("Tone", TONES)
+    audience = st.selectbox("Target Audience", AUDIENCES)
     length = st.slider("Length (words)", 80, 240, 150, 10)
-    spelling = st.selectbox("Spelling", ["UK", "US"])
+    spelling = st.selectbox("Spelling", SPELLINGS)
     include_keywords = st.text_input("Must-include keywords (comma-separated)", placeholder="near schools, chain-free")
     avoid_phrases   = st.text_input("Avoid phrases (comma-separated)", placeholder="The property, apologies")
-    format_choice = st.selectbox("Format", [
-        "Paragraphs",
-        "Short summary + paragraph",
-        "Headline + paragraph"
-    ])
+    format_choice = st.selectbox("Format", FORMAT_CHOICES)
 
     st.subheader("Extras")
     add_title   = st.checkbox("Generate a property headline/title", value=True)
     add_cta     = st.checkbox("Generate a short call-to-action line", value=True)
     add_bullets = st.checkbox("Add 3 selling-point bullets (optional)", value=False)
+    fresh       = st.checkbox("Force fresh variants (ignore cached results)", value=False)
 
     submitted = st.form_submit_button("✨ Generate Listing")
 
 # ================== Prompt Builder ==================
-def build_prompt() -> str:
-    kw = [k.strip() for k in include_keywords.split(",") if k.strip()]
-    avoid = [k.strip() for k in avoid_phrases.split(",") if k.strip()]
+SYSTEM_PROMPT = "You write excellent property listings."  # keep byte-identical for OpenAI prompt caching
+SPELLING_NOTES = {"UK": "Use UK spelling.", "US": "Use US spelling."}
+TITLE_CLAUSES   = {True: "If appropriate, include a property headline/title.", False: "Do not include a separate headline."}
+CTA_CLAUSES     = {True: "End with a short one-line call to action.", False: "Do not include a call to action."}
+BULLETS_CLAUSES = {True: "Also include 3 concise selling-point bullets.", False: "Do not use bullet lists."}
+_CSV_RE = re.compile(r"\s*,\s*")
+_ADDR_RE = re.compile(r"^[^\x00-\x1f\x7f<>]{2,120}$")  # any text but control chars and <>
+
+def split_csv(text: str) -> List[str]:
+    """'a, b ,,c ' -> ['a', 'b', 'c'] (split + strip in one regex pass)."""
+    return [k for k in _CSV_RE.split(text.strip()) if k]
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_prompt(
+    address: str, beds: int, baths: int, property_type: str, features: str,
+    tone: str, audience: str, length: int, spelling: str,
+    include_keywords: str, avoid_phrases: str, format_choice: str,
+    add_title: bool, add_cta: bool, add_bullets: bool,
+) -> str:
+    """Pure function of the form inputs, so reruns with the same inputs hit the cache."""
+    kw = split_csv(include_keywords)
+    avoid = split_csv(avoid_phrases)
     label_beds  = "studio" if beds == 0 else f"{beds}-bedroom"
     label_baths = f"{baths} bathroom" if baths == 1 else f"{baths} bathrooms"
-    words_hint  = f"Aim for ~{length} words (±15%)."
-    spelling_note = "Use UK spelling." if spelling == "UK" else "Use US spelling."
+    spelling_note = SPELLING_NOTES[spelling]
 
-    bullets_clause = "Also include 3 concise selling-point bullets." if add_bullets else "Do not use bullet lists."
-    title_clause   = "If appropriate, include a property headline/title." if add_title else "Do not include a separate headline."
-    cta_clause     = "End with a short one-line call to action." if add_cta else "Do not include a call to action."
+    bullets_clause = BULLETS_CLAUSES[bool(add_bullets)]
+    title_clause   = TITLE_CLAUSES[bool(add_title)]
+    cta_clause     = CTA_CLAUSES[bool(add_cta)]
     must_include   = ("Ensure you naturally include these keywords: " + ", ".join(kw) + ".") if kw else ""
     avoid_text     = ("Avoid using these words/phrases: " + ", ".join(avoid) + ".") if avoid else ""
 
@@ -271,87 +532,299 @@ Return only the listing text (no extra commentary).
 """.strip()
 
 # ================== Generation ==================
-def generate_variants(n: int) -> List[str]:
-    prompt = build_prompt()
-    outs = []
-    for i in range(n):
-        try:
-            resp = client.chat.completions.create(
+STREAM_RENDER_INTERVAL = 0.1  # seconds between live preview repaints
+STREAM_CURSOR = "▌"
+
+@st.cache_resource
+def _generation_cache() -> TTLCache:
+    """(sha256(prompt), model, temperature, n) -> (variants, expires_at)."""
+    return new_ttl_cache()
+
+def _messages(prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+def _stream_n(
+    prompt: str, model: str, temperature: float, n: int,
+    placeholders: Optional[List[Any]],
+) -> List[str]:
+    """One request with n= samples (prompt sent and billed once), streamed into placeholders."""
+    parts: List[List[str]] = [[] for _ in range(n)]
+    last_paint = 0.0
+    stream = client.chat.completions.create(
+        model=model,
+        messages=_messages(prompt),
+        temperature=temperature,
+        max_tokens=700,
+        n=n,
+        stream=True,
+    )
+    for chunk in stream:
+        for c in chunk.choices:
+            if c.delta and c.delta.content and c.index < n:
+                parts[c.index].append(c.delta.content)
+        # Throttle repaints so Streamlit isn't flooded with deltas
+        if placeholders and time.monotonic() - last_paint >= STREAM_RENDER_INTERVAL:
+            last_paint = time.monotonic()
+            for ph, p in zip(placeholders, parts):
+                ph.markdown("".join(p) + STREAM_CURSOR)
+    return ["".join(p).strip() for p in parts]
+
+async def _stream_each(
+    prompt: str, model: str, temperature: float, n: int,
+    placeholders: Optional[List[Any]],
+) -> List[Any]:
+    """n concurrent single-sample requests (for models that reject n>1); str or Exception per slot."""
+    import httpx
+    from openai import AsyncOpenAI
+
+    # Async clients are bound to their event loop, so this one lives only for this call;
+    # with HTTP/2 the n requests multiplex over a single connection
+    http_client = httpx.AsyncClient(**_http_client_kwargs())
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client) as aclient:
+        async def one(i: int) -> str:
+            parts: List[str] = []
+            last_paint = 0.0
+            stream = await aclient.chat.completions.create(
                 model=model,
-                messages=[
-                    {"role": "system", "content": "You write excellent property listings."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=TEMPERATURE,
+                messages=_messages(prompt),
+                temperature=temperature,
                 max_tokens=700,
+                stream=True,
             )
-            text = (resp.choices[0].message.content or "").strip()
-            if text:
-                outs.append(text)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                if placeholders and time.monotonic() - last_paint >= STREAM_RENDER_INTERVAL:
+                    last_paint = time.monotonic()
+                    placeholders[i].markdown("".join(parts) + STREAM_CURSOR)
+            return "".join(parts).strip()
+
+        return await asyncio.gather(*(one(i) for i in range(n)), return_exceptions=True)
+
+@st.cache_resource
+def _models_without_n() -> set:
+    """Models seen rejecting n>1; later calls go straight to the fan-out path."""
+    return set()
+
+def _rejects_n(e: Exception) -> bool:
+    """True if the API refused the request because of the n parameter."""
+    return getattr(e, "param", None) == "n" or "'n'" in str(e)
+
+def generate_variants(
+    prompt: str, model: str, temperature: float, n: int,
+    placeholders: Optional[List[Any]] = None,
+) -> List[str]:
+    """Generate n variants, painting partial text into placeholders[i] if given."""
+    outs: List[str] = []
+    single_request = n == 1 or model not in _models_without_n()
+    if single_request:
+        try:
+            outs = _stream_n(prompt, model, temperature, n, placeholders)
         except Exception as e:
-            st.error(f"OpenAI error (variant {i+1}): {e}")
-            break
-    return outs
+            if not (n > 1 and _rejects_n(e)):
+                st.error(f"OpenAI error: {e}")
+                return []
+            _models_without_n().add(model)
+            single_request = False
+    if not single_request:
+        # Model doesn't support n>1: fan out concurrently instead of looping
+        for i, r in enumerate(asyncio.run(_stream_each(prompt, model, temperature, n, placeholders)), start=1):
+            if isinstance(r, Exception):
+                st.error(f"OpenAI error (variant {i}): {r}")
+            else:
+                outs.append(r)
+    return [t for t in outs if t]
+
+# ================== Batch Regeneration ==================
+def submit_history_batch(items: List[Dict[str, Any]], model: str) -> str:
+    """Queue history items on the Batch API (~50% cheaper, done within 24h); returns batch id."""
+    lines = [
+        json.dumps({
+            # "index|address", so results stay labelled even without this session's history
+            "custom_id": f"{i}|{it['inputs'].get('address') or ''}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": _messages(it["prompt"]),
+                "temperature": TEMPERATURE,
+                "max_tokens": 700,
+                "n": max(1, len(it["outputs"])),
+            },
+        })
+        for i, it in enumerate(items)
+    ]
+    upload = client.files.create(
+        file=("history_batch.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window="24h",
+    )
+    return batch.id
+
+def _read_jsonl_rows(file_id: str) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in client.files.content(file_id).text.splitlines() if line.strip()]
+
+BATCH_TERMINAL_STATUSES = ("completed", "expired", "cancelled", "failed")
+
+@dataclass
+class BatchReport:
+    status: str
+    total: int = 0                                                   # requests in the batch
+    labels: Dict[int, str] = field(default_factory=dict)             # custom_id index -> address
+    results: Dict[int, List[str]] = field(default_factory=dict)      # index -> variants
+    failed: List[int] = field(default_factory=list)                  # indexes that errored
+
+def _split_custom_id(custom_id: str) -> Tuple[int, str]:
+    idx, _, label = str(custom_id).partition("|")
+    return int(idx), label
+
+def read_history_batch(batch_id: str) -> BatchReport:
+    """Status plus whatever finished; expired/cancelled batches can still hold partial output."""
+    b = client.batches.retrieve(batch_id)
+    counts = getattr(b, "request_counts", None)
+    report = BatchReport(status=b.status, total=int(getattr(counts, "total", 0) or 0))
+    if b.status not in BATCH_TERMINAL_STATUSES:
+        return report
+    if b.output_file_id:
+        for row in _read_jsonl_rows(b.output_file_id):
+            idx, label = _split_custom_id(row["custom_id"])
+            report.labels[idx] = label
+            resp = row.get("response") or {}
+            if row.get("error") or resp.get("status_code") != 200:
+                report.failed.append(idx)
+                continue
+            choices = (resp.get("body") or {}).get("choices", [])
+            texts = [((c.get("message") or {}).get("content") or "").strip() for c in choices]
+            report.results[idx] = [t for t in texts if t]
+    if b.error_file_id:
+        for row in _read_jsonl_rows(b.error_file_id):
+            idx, label = _split_custom_id(row["custom_id"])
+            report.labels[idx] = label
+            report.failed.append(idx)
+    report.failed = sorted(set(report.failed) - set(report.results))
+    return report
+
+def to_batch_bundle(labels: Dict[int, str], results: Dict[int, List[str]]) -> bytes:
+    """One section per history item, headed by its address, with that item's variants."""
+    buf = bytearray()
+    for idx in sorted(results):
+        label = labels.get(idx) or f"Listing {idx + 1}"
+        if buf:
+            buf += b"\n"
+        buf += f"##### {label} #####\n".encode("utf-8")
+        buf += to_txt_bundle(results[idx])
+    return bytes(buf)
+
+def ellipsize(s: str, n: int = 160) -> str:
+    return s[:n] + "…" if len(s) > n else s
 
 def to_txt_bundle(texts: List[str]) -> bytes:
-    body = []
+    # Encode straight into one buffer (no intermediate joined str)
+    buf = bytearray()
     for idx, t in enumerate(texts, start=1):
-        body.append(f"=== VARIANT {idx} ===\n{t}\n")
-    return "\n".join(body).encode("utf-8")
+        if idx > 1:
+            buf += b"\n"
+        buf += f"=== VARIANT {idx} ===\n".encode("utf-8")
+        buf += t.encode("utf-8")
+        buf += b"\n"
+    return bytes(buf)
 
 # ================== Submit Logic (caps + cooldown) ==================
 if submitted:
-    if not address.strip():
-        st.error("Please enter an address/location.")
+    if not _ADDR_RE.match(address.strip()):
+        st.error("Please enter an address/location (2–120 characters, without < or >).")
     else:
-        now = time.time()
+        now = time.time()        # wall clock: cache expiry
+        mono = time.monotonic()  # cooldown: immune to clock jumps
         usage = st.session_state.usage
-        is_admin = bool(usage.get("bypass"))
-
-        # Enforce caps unless admin override
-        if not is_admin:
-            # Daily limit
-            if usage["count"] >= USAGE_DAILY_LIMIT:
-                reset_at = dt.datetime.combine(dt.date.today() + dt.timedelta(days=1), dt.time.min)
-                mins_left = int((reset_at - dt.datetime.now()).total_seconds() // 60)
-                st.error(f"Daily limit reached. Resets in ~{mins_left} minutes.")
+        is_admin = bool(usage.bypass)
+        n = int(variants)
+
+        prompt = build_prompt(
+            address, int(beds), int(baths), property_type, features,
+            tone, audience, int(length), spelling,
+            include_keywords, avoid_phrases, format_choice,
+            add_title, add_cta, add_bullets,
+        )
+        gen_key = (hashlib.sha256(prompt.encode("utf-8")).hexdigest(), model, TEMPERATURE, n)
+        outs = None if fresh else ttl_get(_generation_cache(), gen_key, now)
+        cached = outs is not None
+
+        # Enforce caps unless admin override (cache hits are free)
+        if not is_admin and not cached:
+            # Daily limit (token bucket)
+            refill_usage(usage, mono)
+            if usage.tokens < 1:
+                if USAGE_REFILL_RATE > 0:
+                    mins_left = int((1 - usage.tokens) / USAGE_REFILL_RATE // 60) + 1
+                    st.error(f"Daily limit reached. Next generation available in ~{mins_left} minutes.")
+                else:
+                    st.error("Daily limit reached.")
                 st.stop()
 
             # Cooldown between clicks
-            since = now - float(usage["last_ts"])
+            since = mono - usage.last_ts
             if since < USAGE_COOLDOWN_SECONDS:
                 wait = int(USAGE_COOLDOWN_SECONDS - since + 1)
                 st.warning(f"Please wait {wait}s before generating again.")
                 st.stop()
 
-        with st.spinner("Generating…"):
-            outs = generate_variants(int(variants))
+        if not cached:
+            # Live preview while tokens stream in; replaced by the result cards below
+            live = st.empty()
+            with live.container():
+                placeholders = []
+                for i in range(1, n + 1):
+                    st.markdown(f"<div class='variant-title'>Variant {i}</div>", unsafe_allow_html=True)
+                    ph = st.empty()
+                    ph.caption("Generating…")
+                    placeholders.append(ph)
+            outs = generate_variants(prompt, model, TEMPERATURE, n, placeholders)
+            live.empty()
+            if outs:
+                ttl_put(_generation_cache(), gen_key, outs, GENERATION_CACHE_TTL, GENERATION_CACHE_ENTRIES, now)
 
         if not outs:
             st.warning("No text returned. Try adjusting inputs and generate again.")
         else:
-            if not is_admin:
-                usage["count"] += 1
-                usage["last_ts"] = now
+            if cached:
+                st.caption("Showing previously generated results for these exact inputs (no generation used). "
+                           "Tick “Force fresh variants” for new ones.")
+            elif not is_admin:
+                usage.tokens -= 1
+                usage.last_ts = mono
 
             st.session_state.last_variants = outs
-            st.session_state.history.append({
-                "inputs": {
-                    "address": address, "beds": beds, "baths": baths,
-                    "property_type": property_type, "features": features,
-                    "tone": tone, "audience": audience, "length": length,
-                    "spelling": spelling, "include_keywords": include_keywords,
-                    "avoid_phrases": avoid_phrases, "format_choice": format_choice,
-                    "title": add_title, "cta": add_cta, "bullets": add_bullets,
-                },
-                "outputs": outs,
-                "ts": int(time.time())
-            })
+            # A cache hit already in this session's history isn't a new entry
+            seen = cached and any(
+                h.get("prompt") == prompt and h.get("outputs") == outs for h in st.session_state.history
+            )
+            if not seen:
+                st.session_state.history.append({
+                    "inputs": {
+                        "address": address, "beds": beds, "baths": baths,
+                        "property_type": property_type, "features": features,
+                        "tone": tone, "audience": audience, "length": length,
+                        "spelling": spelling, "include_keywords": include_keywords,
+                        "avoid_phrases": avoid_phrases, "format_choice": format_choice,
+                        "title": add_title, "cta": add_cta, "bullets": add_bullets,
+                    },
+                    "prompt": prompt,
+                    "outputs": outs,
+                    "previews": [ellipsize(o) for o in outs],
+                    "ts": int(now),
+                    "ts_str": time.strftime("%Y-%m-%d %H:%M", time.localtime(now)),
+                })
 
             st.subheader("Results")
             for i, text in enumerate(outs, start=1):
                 st.markdown(f"<div class='variant-title'>Variant {i}</div>", unsafe_allow_html=True)
-                st.markdown(f"<div class='result-card'>{textwrap.dedent(text)}</div>", unsafe_allow_html=True)
+                st.markdown(f"<div class='result-card'>{text}</div>", unsafe_allow_html=True)
 
                 with st.expander("Show raw text (copy)"):
                     st.text_area(label=f"Variant {i} (raw)", value=text, height=220, key=f"raw_{i}")
@@ -364,18 +837,90 @@ if submitted:
             )
 
 # ================== History ==================
-with st.expander("🕘 History (this session)"):
-    if not st.session_state.history:
-        st.caption("No history yet.")
-    else:
-        for item in reversed(st.session_state.history[-5:]):
-            ts = time.strftime("%Y-%m-%d %H:%M", time.localtime(item["ts"]))
-            meta = item["inputs"]
-            st.markdown(f"**{meta.get('address','(no address)')}** — {ts}")
-            st.caption(f"{meta.get('beds')} bd / {meta.get('baths')} ba · {meta.get('property_type')}")
-            for j, out in enumerate(item["outputs"], start=1):
-                st.markdown(f"*Variant {j}:* {out[:160]}{'…' if len(out)>160 else ''}")
-            st.markdown("---")
+# A fragment: the bulk-regenerate buttons rerun only this panel, not the whole app
+@st.fragment
+def render_history():
+    with st.expander("🕘 History (this session)"):
+        # A batch restored from the URL is shown even when a refresh emptied the history
+        if not st.session_state.history and not st.session_state.history_batch:
+            st.caption("No history yet.")
+        else:
+            recent_tab, bulk_tab = st.tabs(["Recent", "Bulk regenerate"])
+            with recent_tab:
+                if not st.session_state.history:
+                    st.caption("No history yet.")
+                for item in itertools.islice(reversed(st.session_state.history), 5):
+                    meta = item["inputs"]
+                    st.markdown(f"**{meta.get('address','(no address)')}** — {item['ts_str']}")
+                    st.caption(f"{meta.get('beds')} bd / {meta.get('baths')} ba · {meta.get('property_type')}")
+                    for j, preview in enumerate(item["previews"], start=1):
+                        st.markdown(f"*Variant {j}:* {preview}")
+                    st.markdown("---")
+
+            with bulk_tab:
+                st.caption("Re-run every listing in this session's history via OpenAI's Batch API "
+                           "(about half the cost; results arrive within 24 hours).")
+                size = len(st.session_state.history)
+                usage = st.session_state.usage
+                if size and st.button(f"Queue {size} listing(s) with {BATCH_MODEL}"):
+                    refill_usage(usage, time.monotonic())
+                    if not usage.bypass and usage.tokens < size:
+                        st.error(f"Not enough generations left ({int(usage.tokens)}) for {size} listing(s).")
+                    else:
+                        try:
+                            batch_id = submit_history_batch(list(st.session_state.history), BATCH_MODEL)
+                            charged = 0 if usage.bypass else size
+                            usage.tokens -= charged
+                            st.session_state.history_batch = {
+                                "id": batch_id, "size": size, "charged": charged, "report": None,
+                                "labels": [h["inputs"].get("address") or "" for h in st.session_state.history],
+                            }
+                            st.query_params["b"] = batch_id
+                            st.rerun()  # full rerun so the sidebar token count updates
+                        except Exception as e:
+                            st.error(f"OpenAI batch error: {e}")
+
+                batch = st.session_state.history_batch
+                if batch:
+                    st.markdown(f"Batch `{batch['id']}`" + (f" ({batch['size']} listing(s))" if batch["size"] else ""))
+                    if st.button("Check batch status"):
+                        try:
+                            report = read_history_batch(batch["id"])
+                            batch["report"] = report
+                            if report.status in BATCH_TERMINAL_STATUSES and batch["charged"]:
+                                # Only pay for listings that actually came back
+                                undelivered = (batch["size"] or report.total) - len(report.results)
+                                refund = min(batch["charged"], max(0, undelivered))
+                                batch["charged"] = 0
+                                if refund:
+                                    usage.tokens = min(float(USAGE_DAILY_LIMIT), usage.tokens + refund)
+                                    st.rerun()  # full rerun so the sidebar token count updates
+                        except Exception as e:
+                            st.error(f"OpenAI batch error: {e}")
+
+                    report = batch.get("report")
+                    if report:
+                        st.info(f"Status: {report.status}")
+                        if report.status in BATCH_TERMINAL_STATUSES:
+                            labels = dict(report.labels)
+                            for i, address in enumerate(batch["labels"]):
+                                labels.setdefault(i, address)
+                            total = batch["size"] or report.total
+                            missing = sorted(set(range(total)) - set(report.results) - set(report.failed))
+                            for i in report.failed + missing:
+                                label = labels.get(i) or f"Listing {i + 1}"
+                                st.warning(f"No result for “{label}” ({'failed' if i in report.failed else 'missing'}).")
+                            if report.results:
+                                st.download_button(
+                                    "⬇️ Download regenerated listings (.txt)",
+                                    data=to_batch_bundle(labels, report.results),
+                                    file_name="listing_batch.txt",
+                                    mime="text/plain",
+                                )
+                            else:
+                                st.error(f"The batch ended ({report.status}) without any usable results.")
+
+render_history()
 
 st.markdown("<hr/>", unsafe_allow_html=True)
 st.caption("Unlocked via Gumroad access key or admin override. Contact: yaseen.valji@gmail.com")